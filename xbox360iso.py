@@ -5,14 +5,76 @@
 # This code is licensed under MIT license (see LICENSE for details)
 #
 
-import binascii
 import csv
-import io
-import os.path
-from struct import unpack
-import sys
+import functools
+import json
+import mmap
+import os
+import shutil
+from struct import Struct
+import threading
+import time
 import urllib.request
 
+# magic at the start of an xbox volume descriptor
+_XBOX_MEDIA_MAGIC = b'MICROSOFT*XBOX*MEDIA'
+
+# precompiled formats for the fixed size fields read from the iso and xex
+_U32_BE = Struct('>I')
+# header_id, address of a xex general info table entry
+_XEX_INFO_ENTRY = Struct('>II')
+# file_sector, file_size of a gdf directory entry
+_DIR_ENTRY = Struct('<II')
+# media_id, version, base_version, title_id, platform, executable_type,
+# disc_number, disc_count of the xex execution info
+_XEX_EXEC = Struct('>4sII4sBBBB')
+
+
+# bump when the game name index keys change so older caches are rebuilt
+_GAME_NAME_INDEX_VERSION = 1
+
+
+@functools.lru_cache(maxsize=1)
+def _load_game_name_index(csv_path, csv_mtime):
+    # reuse the cached index if it is at least as new as the csv, a cache
+    # that can't be read or is from another version is rebuilt
+    cache_path = csv_path + '.json'
+    try:
+        if os.path.getmtime(cache_path) >= csv_mtime:
+            with open(cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+            if isinstance(cache, dict) and cache.get('version') == _GAME_NAME_INDEX_VERSION and \
+               isinstance(cache.get('index'), dict):
+                return cache['index']
+    except (OSError, ValueError):
+        pass
+
+    # index game names by the media_id each column ends with, media_ids
+    # are 8 hex characters so shorter columns can never match
+    game_name_index = {}
+    with open(csv_path, 'r') as csv_file:
+        reader = csv.reader(csv_file, delimiter=',')
+        for row in reader:
+            for col in row:
+                if len(col) >= 8:
+                    game_name_index.setdefault(col[-8:].upper(), row[0])
+
+    # write the cache under a temporary name and swap it into place so
+    # concurrent loads never read a partial file, the cache is optional
+    # so an unwritable directory is ignored
+    cache_tmp_path = '%s.%d.%d' % (cache_path, os.getpid(), threading.get_ident())
+    try:
+        with open(cache_tmp_path, 'w') as cache_file:
+            json.dump({'version': _GAME_NAME_INDEX_VERSION, 'index': game_name_index}, cache_file)
+        os.replace(cache_tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(cache_tmp_path)
+        except OSError:
+            pass
+
+    return game_name_index
+
 
 class Xbox360ISO(object):
     """
@@ -28,7 +90,7 @@ class Xbox360ISO(object):
                          'XGD3': 0x2080000,
                          'XSF': 0}
 
-        self.csv_file = None
+        self.csv_loaded = False
         self.csv_settings = {'local': 'GameNameLookup.csv',
                              'url': 'http://abgx360.net/Apps/Stealth360/GameNameLookup.csv',
                              'force_update': False,
@@ -37,27 +99,34 @@ class Xbox360ISO(object):
                              'min_age': 60 * 60 * 24}
 
     def parse(self, filename):
-        # open iso
-        iso_file = open(filename, "rb")
+        # map iso into memory, every read at a known offset becomes a slice,
+        # images are 7-8 GB so this needs a 64-bit python
+        with open(filename, "rb") as iso_file:
+            try:
+                iso_map = mmap.mmap(iso_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file can't be mapped
+                print('Unknown ISO format')
+                return False
 
-        # check iso is an xbox 360 game and record some details
-        iso_info = self.check_iso(iso_file)
-        if iso_info is False:
-            iso_file.close()
-            return False
+        try:
+            # check iso is an xbox 360 game and record some details
+            iso_info = self.check_iso(iso_map)
+            if iso_info is False:
+                return False
 
-        # find and extract default.xex from the iso
-        xex_buffer = self.extract_defaultxex(iso_file, iso_info)
-        if xex_buffer is False:
-            iso_file.close()
-            return False
-        else:
-            iso_info['defaultxex'] = xex_buffer
+            # find and extract default.xex from the iso
+            xex_bytes = self.extract_defaultxex(iso_map, iso_info)
+            if xex_bytes is False:
+                return False
+            else:
+                iso_info['defaultxex'] = xex_bytes
+        finally:
+            iso_map.close()
 
         # extract game details from default.xex
-        xex_info = self.extract_xex_info(xex_buffer)
+        xex_info = self.extract_xex_info(xex_bytes)
         if xex_info is False:
-            iso_file.close()
             return False
 
         # lookup the full game name
@@ -65,124 +134,105 @@ class Xbox360ISO(object):
 
         props = iso_info.copy()
         props.update(xex_info)
-
-        iso_file.close()
         return props
 
-    def check_iso(self, iso_file):
+    def check_iso(self, iso_map):
         iso_info = {}
 
         iso_info['sector_size'] = 0x800
-        iso_file.seek((0x20 * iso_info['sector_size']))
-        if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-            iso_info['root_offset'] = self.iso_type['XSF']
+
+        # probe the volume descriptor of each type of xbox media, taking the
+        # root directory fields that follow the magic in the same slice
+        for media_type in ('XSF', 'GDF', 'XGD3'):
+            volume_descriptor_offset = (0x20 * iso_info['sector_size']) + self.iso_type[media_type]
+            volume_descriptor = iso_map[volume_descriptor_offset:volume_descriptor_offset + 28]
+            if volume_descriptor[0:20] == _XBOX_MEDIA_MAGIC:
+                break
+        else:
+            print('Unknown ISO format')
+            return False
+
+        if media_type == 'XSF':
             print('Original Xbox ISO format not supported')
             return False
-        else:
-            iso_file.seek((0x20 * iso_info['sector_size']) + self.iso_type['GDF'])
-            if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-                iso_info['root_offset'] = self.iso_type['GDF']
-            else:
-                iso_file.seek((0x20 * iso_info['sector_size']) + self.iso_type['XGD3'])
-                if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-                    iso_info['root_offset'] = self.iso_type['XGD3']
-                else:
-                    print('Unknown ISO format')
-                    return False
-        iso_file.seek((0x20 * iso_info['sector_size']) + iso_info['root_offset'])
-        iso_info['identifier'] = iso_file.read(20).decode("ascii", "ignore")
-        iso_info['root_dir_sector'] = unpack('I', iso_file.read(4))[0]
-        iso_info['root_dir_size'] = unpack('I', iso_file.read(4))[0]
-        iso_info['image_size'] = os.fstat(iso_file.fileno()).st_size
+
+        iso_info['root_offset'] = self.iso_type[media_type]
+        iso_info['identifier'] = volume_descriptor[0:20].decode("ascii", "ignore")
+        iso_info['root_dir_sector'], iso_info['root_dir_size'] = _DIR_ENTRY.unpack_from(volume_descriptor, 20)
+        iso_info['image_size'] = len(iso_map)
         iso_info['volume_size'] = iso_info['image_size'] - iso_info['root_offset']
-        iso_info['volume_sectors'] = iso_info['volume_size'] / iso_info['sector_size']
+        iso_info['volume_sectors'] = iso_info['volume_size'] // iso_info['sector_size']
         return iso_info
 
     @staticmethod
-    def extract_defaultxex(iso_file, iso_info):
-        # seek to root sector
-        iso_file.seek((iso_info['root_dir_sector'] * iso_info['sector_size']) + iso_info['root_offset'])
-
-        # read the root sector into a bytes object
-        root_sector_buffer = io.BytesIO()
-        root_sector_buffer.write(iso_file.read(iso_info['root_dir_size']))
-        root_sector_buffer.seek(0)
-
-        # case insensitive search of root sector for default.xex
-        for i in range(0, iso_info['root_dir_size'] - 12):
-            root_sector_buffer.seek(i)
-            root_sector_buffer.read(1)  # file_attribute
-            if int.from_bytes(root_sector_buffer.read(1), byteorder='big') == 11:  # 11 chars in filename
-                if root_sector_buffer.read(11).decode("ascii", "ignore").lower() == 'default.xex':
-                    # found default.xex
-                    root_sector_buffer.seek(i - 8)
-                    file_sector = unpack('I', root_sector_buffer.read(4))[0]
-                    file_size = unpack('I', root_sector_buffer.read(4))[0]
-
-                    # seek to default.xex
-                    iso_file.seek(iso_info['root_offset'] + (file_sector * iso_info['sector_size']))
-
-                    # read default.xex into a bytes object
-                    xex_buffer = io.BytesIO()
-                    xex_buffer.write(iso_file.read(file_size))
-                    return xex_buffer
+    def extract_defaultxex(iso_map, iso_info):
+        # slice the root sector into a bytes object
+        root_offset = (iso_info['root_dir_sector'] * iso_info['sector_size']) + iso_info['root_offset']
+        root_bytes = iso_map[root_offset:root_offset + iso_info['root_dir_size']]
+
+        # case insensitive search of root sector for default.xex, including
+        # the 11 char filename length so only real entries match
+        pos = root_bytes.lower().find(b'\x0bdefault.xex')
+        if pos >= 9:
+            # found default.xex, sector and size precede the file_attribute
+            file_sector, file_size = _DIR_ENTRY.unpack_from(root_bytes, pos - 9)
+
+            # slice default.xex into a bytes object
+            file_offset = iso_info['root_offset'] + (file_sector * iso_info['sector_size'])
+            return iso_map[file_offset:file_offset + file_size]
         print('default.xex not found')
         return False
 
     @staticmethod
-    def extract_xex_info(xex_buffer):
+    def extract_xex_info(xex_bytes):
         xex_info = {}
 
-        xex_buffer.seek(0)
-        if xex_buffer.read(4).decode("ascii", "ignore") == 'XEX2':
+        if xex_bytes[0:4] == b'XEX2':
+
+            # check the xex is large enough to hold its header
+            if len(xex_bytes) < 0x18:
+                print('Xex header is beyond size of default.xex')
+                return False
 
             # get the starting address of code from 0x08 in the xex
-            xex_buffer.seek(0x08)
-            code_offset = unpack('>I', xex_buffer.read(4))[0]
+            code_offset = _U32_BE.unpack_from(xex_bytes, 0x08)[0]
             # check if the code_offset is too large
-            if code_offset > sys.getsizeof(xex_buffer):
+            if code_offset > len(xex_bytes):
                 print('Starting address of Xex code is beyond size of default.xex')
                 return False
 
             # get the starting address of the xex certificate
-            xex_buffer.seek(0x10)
-            cert_offset = unpack('>I', xex_buffer.read(4))[0]
+            cert_offset = _U32_BE.unpack_from(xex_bytes, 0x10)[0]
             # check if the cert_offset is too large
             if cert_offset > code_offset:
                 print('Xex certificate offset is beyond the starting address of Xex code')
                 return False
 
             # get the number of entries in the general info table
-            xex_buffer.seek(0x14)
-            info_table_num_entries = unpack('>I', xex_buffer.read(4))[0]
+            info_table_num_entries = _U32_BE.unpack_from(xex_bytes, 0x14)[0]
             # check that there aren't too many entries
             if info_table_num_entries * 8 + 24 > code_offset:
                 print('Xex general info table has entries that spill over into the Xex code')
                 return False
 
-            execution_info_address = False
-            execution_info_table_flags = bytes([0x00, 0x04, 0x00, 0x06])
-
-            # iterate through info table, finding addresses
-            for i in range(0, info_table_num_entries):
-                header_id = unpack('>I', xex_buffer.read(4))[0]
+            # map each header id in the info table to its address
+            info_table_end = 0x18 + info_table_num_entries * 8
+            info_table = dict(_XEX_INFO_ENTRY.iter_unpack(xex_bytes[0x18:info_table_end]))
+            execution_info_address = info_table.get(0x00040006, False)
 
-                if header_id == unpack('>I', execution_info_table_flags)[0]:
-                    execution_info_address = unpack('>I', xex_buffer.read(4))[0]
-                else:
-                    xex_buffer.read(4)
+            # check the execution info fits within the xex
+            if execution_info_address is not False and \
+               execution_info_address + _XEX_EXEC.size > len(xex_bytes):
+                print('Xex execution info is beyond size of default.xex')
+                return False
 
-            # seek to each address and extract info
+            # extract info from the execution info address
             if execution_info_address is not False:
-                xex_buffer.seek(execution_info_address)
-                xex_info['media_id'] = binascii.hexlify(xex_buffer.read(4)).decode("ascii", "ignore").upper()
-                xex_info['version'] = unpack('>I', xex_buffer.read(4))[0]
-                xex_info['base_version'] = unpack('>I', xex_buffer.read(4))[0]
-                xex_info['title_id'] = binascii.hexlify(xex_buffer.read(4)).decode("ascii", "ignore").upper()
-                xex_info['platform'] = ord(xex_buffer.read(1))
-                xex_info['executable_type'] = ord(xex_buffer.read(1))
-                xex_info['disc_number'] = ord(xex_buffer.read(1))
-                xex_info['disc_count'] = ord(xex_buffer.read(1))
+                (media_id, xex_info['version'], xex_info['base_version'], title_id,
+                 xex_info['platform'], xex_info['executable_type'],
+                 xex_info['disc_number'], xex_info['disc_count']) = _XEX_EXEC.unpack_from(xex_bytes, execution_info_address)
+                xex_info['media_id'] = media_id.hex().upper()
+                xex_info['title_id'] = title_id.hex().upper()
             else:
                 return False
 
@@ -193,21 +243,21 @@ class Xbox360ISO(object):
 
     def media_id_to_game_name(self, media_id):
         # check if we've already loaded the csv
-        if self.csv_file is None:
+        if self.csv_loaded is False:
             if (self.csv_settings['force_update'] is True) or \
                (self.csv_exists() is False and self.csv_settings['download_if_missing'] is True):
                 self.download_csv()
 
-            if self.open_csv() is False:
+            if self.csv_exists() is False:
                 return False
+            self.csv_loaded = True
 
             game_name = self.search_csv(media_id)
             if game_name is not None:
                 return game_name
-            elif game_name is None and os.stat(self.csv_settings['local']).st_mtime > self.csv_settings['min_age']:
+            elif self.csv_settings['update_if_no_match'] is True and \
+                    time.time() - os.stat(self.csv_settings['local']).st_mtime > self.csv_settings['min_age']:
                 self.download_csv()
-                if self.open_csv() is False:
-                    return False
                 return self.search_csv(media_id)
 
         return self.search_csv(media_id)
@@ -219,19 +269,28 @@ class Xbox360ISO(object):
             return False
 
     def download_csv(self):
-        urllib.request.urlretrieve(self.csv_settings['url'], self.csv_settings['local'])
+        # stream to a temporary file in large chunks, then swap it into place
+        # so a failed download never leaves a truncated csv behind
+        download_path = '%s.%d.%d.download' % (self.csv_settings['local'], os.getpid(), threading.get_ident())
+        try:
+            with urllib.request.urlopen(self.csv_settings['url']) as response, open(download_path, 'wb') as csv_file:
+                shutil.copyfileobj(response, csv_file, 1 << 20)
+            os.replace(download_path, self.csv_settings['local'])
+        except BaseException:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+            raise
 
     def open_csv(self):
-        if self.csv_exists():
-            self.csv_file = open(self.csv_settings['local'], 'r')
-        else:
+        # the mtime is part of the cache key so a new csv is reloaded
+        try:
+            csv_mtime = os.path.getmtime(self.csv_settings['local'])
+        except FileNotFoundError:
             return False
+        return _load_game_name_index(self.csv_settings['local'], csv_mtime)
 
     def search_csv(self, media_id):
-        self.csv_file.seek(0)
-        reader = csv.reader(self.csv_file, delimiter=',')
-        for row in reader:
-            for col in row:
-                if col.endswith(media_id):
-                    return row[0]
-        return None
\ No newline at end of file
+        game_name_index = self.open_csv()
+        if game_name_index is False:
+            return None
+        return game_name_index.get(media_id.upper())